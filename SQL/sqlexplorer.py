@@ -1,4 +1,9 @@
 import sqlite3
+import json
+import hashlib
+import re
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
@@ -8,63 +13,140 @@ import pymannkendall as mk
 import matplotlib.patheffects as pe
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 from thefuzz import process
+from scipy import sparse
+from scipy.spatial import cKDTree
+from wqtime import from_epoch, TEXT_FORMAT
 
 # rcParams
 plt.rcParams["figure.dpi"] = 300
 
 # Paths
-DB_PATH = "WQ.sqlite"
-Station = "stations"
-data    = "data"
+DB_PATH     = "WQ.sqlite"
+PARQUET_DIR = Path("WQ_parquet") # written by sqlitegen
+Station     = "stations"
+data        = "data"
 
+# "sqlite" or "parquet", parquet reads only the columns/partitions asked for
+BACKEND = "sqlite"
+
+##-----------------------------------------------------------------------------
 # Load data
-con = sqlite3.connect(DB_PATH)
-dfs = pd.read_sql(f"SELECT * FROM {Station}", con).replace(-999999,np.nan)
-dfd = pd.read_sql(f"SELECT * FROM {data}", con).replace(-999999,np.nan)
-con.close()
+def query_table(table, columns=None, years=None, stations=None):
+    """
+    Parameters:
+    - table: "data" or "stations"
+    - columns: list of columns to read, None for all
+    - years: only rows from these years
+    - stations: only rows from these station ids
+    Filters are pushed down to sqlite or to the parquet partitions/row groups.
+    """
+    filters = {"year": years, "station_id": stations}
+    filters = {k: list(v) for k, v in filters.items() if v is not None}
+    if BACKEND == "parquet":
+        import pyarrow.dataset as ds
+        dataset = ds.dataset(PARQUET_DIR / table, format="parquet", partitioning="hive")
+        expr    = None
+        for col, vals in filters.items():
+            cond = ds.field(col).isin(vals)
+            expr = cond if expr is None else expr & cond
+        df = dataset.to_table(columns=columns, filter=expr).to_pandas()
+    else:
+        cols  = ", ".join(f'"{c}"' for c in columns) if columns else "*"
+        where = " AND ".join(f"{col} IN ({', '.join('?' * len(vals))})"
+                             for col, vals in filters.items())
+        sql   = f"SELECT {cols} FROM {table}" + (f" WHERE {where}" if where else "")
+        con   = sqlite3.connect(DB_PATH)
+        df    = pd.read_sql(sql, con, params=[v for vals in filters.values() for v in vals])
+        con.close()
+    return df.replace(-999999,np.nan)
+
+def table_columns(table):
+    if BACKEND == "parquet":
+        import pyarrow.dataset as ds
+        return ds.dataset(PARQUET_DIR / table, format="parquet", partitioning="hive").schema.names
+    con  = sqlite3.connect(DB_PATH)
+    cols = [r[1] for r in con.execute(f"PRAGMA table_info({table})")]
+    con.close()
+    return cols
+
+# Stations are small and read whole, data is read per plot with only the
+# columns/years/stations it needs
+dfs          = query_table(Station)
+DATA_COLUMNS = table_columns(data)
+TIME_COLUMNS = ["epoch", "utc_offset_min"] if "epoch" in DATA_COLUMNS else ["datetime"]
+
+def load_data(variables, years=None, stations=None, with_time=False):
+    cols = ["station_id"] + (TIME_COLUMNS if with_time else []) + list(variables)
+    df   = query_table(data, columns=list(dict.fromkeys(cols)), years=years, stations=stations)
+    # Native datetimes from the stored epoch, older dbs fall back to the text column
+    if with_time and "epoch" in df.columns:
+        df["datetime"] = from_epoch(df["epoch"], df["utc_offset_min"])
+    elif with_time:
+        df["datetime"] = pd.to_datetime(df["datetime"], format=TEXT_FORMAT, errors="coerce")
+    return df
+
+AGG_FUNCS = {"mean": "mean",
+             "median": "median",
+             "min": "min",
+             "max": "max",
+             "std": "std",
+             "count": "count"}
+
+##-----------------------------------------------------------------------------
+# Shared helpers
+def check_variable(variable):
+    if variable not in DATA_COLUMNS:
+        choices = DATA_COLUMNS
+        matches = process.extract(variable, choices)
+        matches = [i[0] for i in matches]
+        raise ValueError(f"{variable} not found in DataFrame. Try one of {*matches,}.")
+
+def check_agg(agg):
+    if agg not in AGG_FUNCS:
+        raise ValueError(f"Unsupported aggregation: {agg}")
+
+# Save and/or show a finished figure
+def finish_fig(fig, outpath=None, show=True):
+    if outpath:
+        fig.savefig(outpath, dpi=300, bbox_inches="tight")
+    if show:
+        plt.show()
+    else:
+        plt.close(fig)
 
 ##-----------------------------------------------------------------------------
 # Plot Stations
-gdf = gpd.GeoDataFrame(dfs, geometry=gpd.points_from_xy(dfs.longitude,dfs.latitude),
-                       crs="EPSG:4326")
-gdf = gdf.to_crs(epsg=3857)             # Reproject for basemap
-fig, ax = plt.subplots(figsize=(9, 7))
-gdf.plot(ax=ax,markersize=12,alpha=0.8)
-ctx.add_basemap(ax,source=ctx.providers.OpenStreetMap.Mapnik)
-# Map frame
-ax.set_xticks([])
-ax.set_yticks([])
-# Title
-ax.set_title("Station Locations")
-# Make citation small
-for txt in ax.texts:
-    txt.set_fontsize(1)
-plt.show()
-# fig.savefig("stations.png",dpi=300,bbox_inches="tight")
+def plot_stations(outpath=None, show=True):
+    gdf = gpd.GeoDataFrame(dfs, geometry=gpd.points_from_xy(dfs.longitude,dfs.latitude),
+                           crs="EPSG:4326")
+    gdf = gdf.to_crs(epsg=3857)             # Reproject for basemap
+    fig, ax = plt.subplots(figsize=(9, 7))
+    gdf.plot(ax=ax,markersize=12,alpha=0.8)
+    ctx.add_basemap(ax,source=ctx.providers.OpenStreetMap.Mapnik)
+    # Map frame
+    ax.set_xticks([])
+    ax.set_yticks([])
+    # Title
+    ax.set_title("Station Locations")
+    # Make citation small
+    for txt in ax.texts:
+        txt.set_fontsize(1)
+    finish_fig(fig, outpath, show)
 
 ##-----------------------------------------------------------------------------
 # Plot variable grouped by stations, **note: not actual sample location**
 def plot_by_var(variable="NPOC_ppm", agg="mean",
-                cmap="turbo", markersize=12):
+                cmap="turbo", markersize=12, years=None,
+                agg_vals=None, outpath=None, show=True):
     
     # Cmap suggestions:
     # "viridis", "plasma", "inferno", "cividis", "turbo", "seismic"
+    # years: optional list of years to aggregate
+    # agg_vals: precomputed station_id/{variable}_{agg} frame (see batch_report)
 
     # Sanity check
-    if variable not in dfd.columns:
-        choices = dfd.columns
-        matches = process.extract(variable, choices)
-        matches = [i[0] for i in matches]
-        raise ValueError(f"{variable} not found in DataFrame. Try one of {*matches,}.")
-        
-    agg_funcs = {"mean": "mean",
-                 "median": "median",
-                 "min": "min",
-                 "max": "max",
-                 "std": "std",
-                 "count": "count"}
-    if agg not in agg_funcs:
-        raise ValueError(f"Unsupported aggregation: {agg}")
+    check_variable(variable)
+    check_agg(agg)
         
     # Make some useful strings
     col     = f"{variable}_{agg}"
@@ -73,9 +155,13 @@ def plot_by_var(variable="NPOC_ppm", agg="mean",
     units   = variable.split("_", 1)[1] if "_" in variable else ""
     
     # Means by station
-    agg_vals = (dfd.groupby("station_id", as_index=False)[variable]
-                 .agg(agg_funcs[agg])
-                 .rename(columns={variable: col}))
+    if agg_vals is None:
+        agg_vals = (load_data([variable], years)
+                     .groupby("station_id", as_index=False)[variable]
+                     .agg(AGG_FUNCS[agg])
+                     .rename(columns={variable: col}))
+    else:
+        agg_vals = agg_vals.copy()
     df = dfs.merge(agg_vals, on="station_id", how="left")
     
     # Do some stats on aggregated values
@@ -157,31 +243,21 @@ def plot_by_var(variable="NPOC_ppm", agg="mean",
         txt.set_path_effects([pe.Stroke(linewidth=1.0, foreground="white"),
                               pe.Normal()])
     
-    plt.show()
-    # outname = f"{aggname}_{variable}.png"
-    # fig.savefig(outname, dpi=300, bbox_inches="tight")
+    finish_fig(fig, outpath, show)
 ##-----------------------------------------------------------------------------
 # Station explorer
 def plot_station(station=None, variable="NPOC_ppm",
-                  cmap="viridis", markersize=40):
+                  cmap="viridis", markersize=40, years=None,
+                  outpath=None, show=True):
     # Sanity check
-    if variable not in dfd.columns:
-        choices = dfd.columns
-        matches = process.extract(variable, choices)
-        matches = [i[0] for i in matches]
-        raise ValueError(f"{variable} not found in DataFrame. Try one of {*matches,}.")
+    check_variable(variable)
     
     # Load data
-    if station:
-        df = dfd[dfd["station_id"] == station].copy()
-        if df.empty:
-            raise ValueError(f"No data found for station {station}")
-    else:
-        df = dfd.copy()
-    
+    df = load_data([variable], years, [station] if station else None, with_time=True)
+    if station and df.empty:
+        raise ValueError(f"No data found for station {station}")
         
     # Parse year
-    df["datetime"]  = pd.to_datetime(df["datetime"], errors="coerce")
     df              = df.dropna(subset=["datetime"])
     df["year"]      = df["datetime"].dt.year
     df["month"]     = df["datetime"].dt.month
@@ -243,9 +319,268 @@ def plot_station(station=None, variable="NPOC_ppm",
         print("Couldn't process Mann-Kendall, check raw data and try again.")
     
     plt.tight_layout()
-    plt.show()
+    finish_fig(fig, outpath, show)
     return month_array
 ##-----------------------------------------------------------------------------
+# Interpolated surfaces
+# Weights depend only on station geometry, so they're built once per grid and
+# method and every variable/period after that is one sparse mat-vec
+GRID_SIZE    = 200   # cells along the longer side of the station bbox
+INTERP_K     = 12    # neighbouring stations per cell
+IDW_POWER    = 2
+KRIGE_RANGE  = 0.33  # exponential variogram range, fraction of bbox diagonal
+KRIGE_NUGGET = 0.0   # nugget as a fraction of the sill
+_weights_cache = {}
+
+def station_xy():
+    pos = dfs.dropna(subset=["latitude", "longitude"]).drop_duplicates("station_id")
+    gdf = gpd.GeoDataFrame(pos, geometry=gpd.points_from_xy(pos["longitude"], pos["latitude"]),
+                           crs="EPSG:4326").to_crs(epsg=3857)
+    xy  = np.column_stack([gdf.geometry.x, gdf.geometry.y])
+    return xy, pos["station_id"].astype(str).to_numpy()
+
+def interp_weights(method="idw", grid_size=GRID_SIZE, k=INTERP_K, use=None):
+    """
+    Parameters:
+    - method: "idw" or "kriging" (ordinary, exponential variogram)
+    - grid_size: cells along the longer side of the grid
+    - k: neighbouring stations used per cell
+    - use: station ids to interpolate from (default all), the grid always
+      covers every station
+    Returns a dict with the sparse weight matrix W (cells x used stations),
+    their station ids, grid shape and extent (EPSG:3857). Cached on the
+    station geometry and the stations used.
+    """
+    xy, ids = station_xy()
+    (xmin, ymin), (xmax, ymax) = xy.min(axis=0), xy.max(axis=0)
+    if use is not None:
+        keep    = np.isin(ids, list(use))
+        xy, ids = xy[keep], ids[keep]
+        if not len(ids):
+            raise ValueError("None of the requested stations have a position")
+    key = (fingerprint(xy.tobytes(), "|".join(ids)), xmin, ymin, xmax, ymax, method, grid_size, k)
+    if key in _weights_cache:
+        return _weights_cache[key]
+    
+    # Grid over the padded bbox, same padding as the maps
+    pad  = 0.03 * max(xmax - xmin, ymax - ymin)
+    xmin, xmax, ymin, ymax = xmin - pad, xmax + pad, ymin - pad, ymax + pad
+    step = max(xmax - xmin, ymax - ymin) / grid_size
+    gx   = np.arange(xmin + step / 2, xmax, step)
+    gy   = np.arange(ymin + step / 2, ymax, step)
+    cells = np.column_stack([a.ravel() for a in np.meshgrid(gx, gy)])
+    
+    # k nearest stations for every cell at once
+    k       = min(k, len(xy))
+    dist, nb = cKDTree(xy).query(cells, k=k)
+    dist, nb = dist.reshape(len(cells), k), nb.reshape(len(cells), k)
+    
+    if method == "idw":
+        with np.errstate(divide="ignore"):
+            w = 1.0 / dist**IDW_POWER
+        exact = np.isinf(w).any(axis=1) # cell sits on a station
+        w[exact] = np.isinf(w[exact]).astype(float)
+    elif method == "kriging":
+        vrange = KRIGE_RANGE * np.hypot(xmax - xmin, ymax - ymin)
+        gamma  = lambda h: KRIGE_NUGGET * (h > 0) + (1 - KRIGE_NUGGET) * (1 - np.exp(-3 * h / vrange))
+        # Batched ordinary kriging systems, one (k+1)x(k+1) per cell
+        pts = xy[nb]
+        A   = np.ones((len(cells), k + 1, k + 1))
+        A[:, :k, :k] = gamma(np.linalg.norm(pts[:, :, None] - pts[:, None, :], axis=-1))
+        A[:, k, k]   = 0
+        A[:, :k, :k] += np.eye(k) * 1e-10 # keep co-located stations solvable
+        b = np.ones((len(cells), k + 1))
+        b[:, :k] = gamma(dist)
+        w = np.linalg.solve(A, b[..., None])[:, :k, 0]
+    else:
+        raise ValueError(f"Unsupported interpolation method: {method}")
+    
+    rows = np.repeat(np.arange(len(cells)), k)
+    W    = sparse.csr_matrix((w.ravel(), (rows, nb.ravel())), shape=(len(cells), len(xy)))
+    extent = (gx[0] - step / 2, gx[-1] + step / 2, gy[0] - step / 2, gy[-1] + step / 2)
+    _weights_cache[key] = {"W": W, "ids": ids, "shape": (len(gy), len(gx)),
+                           "extent": extent}
+    return _weights_cache[key]
+
+def interpolate(values, method="idw"):
+    """
+    Parameters:
+    - values: Series of one value per station_id (NaN/missing allowed)
+    - method: see interp_weights
+    Returns the 2D grid and its extent (EPSG:3857). IDW drops stations
+    without a value by renormalizing the weights of the rest. Kriging weights
+    can be negative so that doesn't hold, the systems are solved again over
+    the stations with a value.
+    """
+    if method == "kriging":
+        grid = interp_weights(method, use=values.dropna().index.astype(str))
+        v    = values.reindex(grid["ids"]).to_numpy(dtype=float)
+        return (grid["W"] @ v).reshape(grid["shape"]), grid["extent"]
+    grid = interp_weights(method)
+    v    = values.reindex(grid["ids"]).to_numpy(dtype=float)
+    m    = ~np.isnan(v)
+    num  = grid["W"] @ np.where(m, v, 0)
+    den  = grid["W"] @ m.astype(float)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        z = np.where(np.abs(den) > 1e-12, num / den, np.nan)
+    return z.reshape(grid["shape"]), grid["extent"]
+
+def plot_surface(variable="NPOC_ppm", agg="mean", method="idw",
+                 months=None, years=None, cmap="turbo",
+                 outpath=None, show=True):
+    # months/years: optional lists to restrict the period aggregated
+    check_variable(variable)
+    check_agg(agg)
+    df = load_data([variable], years, with_time=months is not None)
+    if months is not None:
+        df = df[df["datetime"].dt.month.isin(months)]
+    vals = df.groupby("station_id")[variable].agg(AGG_FUNCS[agg])
+    vals.index = vals.index.astype(str)
+    z, extent = interpolate(vals, method)
+    
+    fig, ax = plt.subplots(figsize=(9, 7))
+    ax.set_xlim(extent[:2])
+    ax.set_ylim(extent[2:])
+    img = ax.imshow(np.ma.masked_invalid(z), extent=extent, origin="lower",
+                    cmap=cmap, alpha=0.75, zorder=2)
+    ctx.add_basemap(ax, source=ctx.providers.OpenStreetMap.Mapnik, zorder=1)
+    xy, ids = station_xy()
+    has_val = np.isin(ids, vals.dropna().index)
+    ax.scatter(xy[has_val, 0], xy[has_val, 1], s=6, c="black", zorder=3)
+    
+    # Map frame
+    ax.set_xticks([])
+    ax.set_yticks([])
+    for txt in ax.texts:
+        txt.set_fontsize(1)
+    
+    # Colorbar and title
+    varname = variable.split("_")[0]
+    units   = variable.split("_", 1)[1] if "_" in variable else ""
+    divider = make_axes_locatable(ax)
+    cax     = divider.append_axes("right", size="8%", pad=0.05)
+    cbar    = fig.colorbar(img, cax=cax)
+    cbar.ax.tick_params(labelsize=9)
+    cbar.ax.set_title(units.upper(), fontsize=10)
+    period = ""
+    if months is not None:
+        period += " months " + ",".join(map(str, months))
+    if years is not None:
+        period += " " + ",".join(map(str, years))
+    ax.set_title(f"{agg.capitalize()} {varname} ({method.upper()}){period}", fontsize=14, pad=16)
+    
+    finish_fig(fig, outpath, show)
+    return z
+
+##-----------------------------------------------------------------------------
+# Batch reports
+# Runs in a worker process, renders one figure without a display
+def render_job(job):
+    plt.switch_backend("Agg")
+    kind, kwargs = job
+    if kind == "var":
+        plot_by_var(**kwargs, show=False)
+    else:
+        plot_station(**kwargs, show=False)
+    return kwargs["outpath"]
+
+def fingerprint(*parts):
+    sha = hashlib.sha1()
+    for part in parts:
+        sha.update(str(part).encode())
+    return sha.hexdigest()
+
+def batch_report(variables=("NPOC_ppm",), aggs=("mean",), stations=None, years=None,
+                 outdir="report", fmt="png", workers=None, force=False):
+    """
+    Parameters:
+    - variables: columns of data to report on
+    - aggs: aggregations for the by-variable maps (keys of AGG_FUNCS)
+    - stations: station ids for the seasonal plots, None for every station
+    - years: optional list of years to report on
+    - outdir: folder for figures, manifest.json and index.html
+    - fmt: "png" or "pdf"
+    - workers: process count, None lets the pool decide
+    - force: re-render figures even if their inputs haven't changed
+    Figures are skipped when the hash of their inputs matches the last run.
+    """
+    for variable in variables:
+        check_variable(variable)
+    for agg in aggs:
+        check_agg(agg)
+    dfd = load_data(variables, years, with_time=True)
+    if stations is None:
+        stations = sorted(dfd["station_id"].dropna().astype(str).unique())
+    
+    outdir   = Path(outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+    manifest = outdir / "manifest.json"
+    previous = json.loads(manifest.read_text()) if manifest.exists() else {}
+    
+    # Every aggregate in one grouped pass
+    grouped  = dfd.groupby("station_id")[list(variables)].agg([AGG_FUNCS[a] for a in aggs])
+    geo_hash = pd.util.hash_pandas_object(dfs[["station_id", "latitude", "longitude"]], index=False).sum()
+    
+    jobs, hashes = [], {}
+    for variable in variables:
+        for agg in aggs:
+            col      = f"{variable}_{agg}"
+            agg_vals = grouped[(variable, AGG_FUNCS[agg])].rename(col).reset_index()
+            name     = f"{agg.capitalize()}_{variable}.{fmt}"
+            hashes[name] = fingerprint("var", variable, agg, years, geo_hash,
+                                       pd.util.hash_pandas_object(agg_vals, index=False).sum())
+            jobs.append((name, ("var", {"variable": variable, "agg": agg, "years": years,
+                                        "agg_vals": agg_vals,
+                                        "outpath": str(outdir / name)})))
+        # Per station hash of the rows plot_station will read
+        rows = dfd[["datetime", variable]]
+        station_hash = (pd.util.hash_pandas_object(rows, index=False)
+                        .groupby(dfd["station_id"].astype(str).to_numpy()).sum())
+        for station in stations:
+            if station not in station_hash.index:
+                continue
+            name = f"{re.sub(r'[^A-Za-z0-9_-]', '_', station)}_{variable}.{fmt}"
+            hashes[name] = fingerprint("station", station, variable, years, station_hash[station])
+            jobs.append((name, ("station", {"station": station, "variable": variable, "years": years,
+                                            "outpath": str(outdir / name)})))
+    
+    # Only render what changed
+    todo = [(name, job) for name, job in jobs
+            if force or previous.get(name) != hashes[name] or not (outdir / name).exists()]
+    print(f"Rendering {len(todo)} of {len(jobs)} figures, {len(jobs) - len(todo)} unchanged.")
+    redo = {name for name, _ in todo}
+    done = {name: previous[name] for name, _ in jobs
+            if name in previous and name not in redo}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(render_job, job): name for name, job in todo}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                future.result()
+                done[name] = hashes[name]
+            except Exception as e:
+                print(f"Failed to render {name}: {e}")
+    manifest.write_text(json.dumps(done, indent=1, sort_keys=True))
+    
+    # Index page
+    by_var     = [name for name, (kind, _) in jobs if kind == "var" and name in done]
+    by_station = [name for name, (kind, _) in jobs if kind == "station" and name in done]
+    def section(title, names):
+        if fmt == "png":
+            items = "".join(f'<figure><img src="{n}" width="480"><figcaption>{n}</figcaption></figure>' for n in names)
+        else:
+            items = "".join(f'<li><a href="{n}">{n}</a></li>' for n in names)
+            items = f"<ul>{items}</ul>"
+        return f"<h2>{title}</h2>{items}"
+    html = ("<html><head><title>WQ Report</title></head><body><h1>WQ Report</h1>"
+            + section("By variable", by_var) + section("By station", by_station)
+            + "</body></html>")
+    (outdir / "index.html").write_text(html)
+    return outdir / "index.html"
+##-----------------------------------------------------------------------------
 # Call
-plot_by_var(variable="NPOC_ppm",agg="median")
-ma=plot_station(station="MR",variable="NPOC_ppm")
+if __name__ == "__main__":
+    plot_stations()
+    plot_by_var(variable="NPOC_ppm",agg="median")
+    ma=plot_station(station="MR",variable="NPOC_ppm")
+    # batch_report(variables=["NPOC_ppm", "DIC_ppm"], aggs=["mean", "median"])
@@ -4,13 +4,44 @@ from pathlib import Path
 from sqlalchemy import create_engine
 from sqlalchemy import inspect, text
 from collections import defaultdict
+from sklearn.neighbors import BallTree
+import hashlib
+import pickle
+import shutil
 import warnings
+import sys
+import re
+from wqtime import parse_datetime, to_epoch, to_text, from_epoch
+from wqsamples import index_rows, RESULTS_TABLE
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
 warnings.filterwarnings("ignore", category=UserWarning, module="openpyxl")
 
 # Path to data folder and name for sqlite db
 DATA_DIR = Path("data")
 engine   = create_engine("sqlite:///WQ.sqlite", isolation_level="SERIALIZABLE")
 
+# How duplicate keys in a load are resolved, see resolve_duplicates.
+# Prompts when run from a terminal, keeps the first row in unattended runs.
+DUPE_POLICIES = ["keep_first", "keep_last", "keep_most_complete", "merge", "reject_file", "ask"]
+DUPE_POLICY   = "ask" if sys.stdin.isatty() else "keep_first"
+
+# Columnar copy of the db for analysis (needs pyarrow), data is split by year.
+# Add "cruise_id" to the partitions to also split each year by cruise.
+PARQUET_DIR        = Path("WQ_parquet")
+PARQUET_PARTITIONS = ["year"]
+
+# Raw CTD/sonde casts (SeaBird .cnv or sonde .csv), streamed in chunks. Full
+# resolution goes to PARQUET_DIR/ctd_raw, depth (or time) bins to ctd_profiles.
+CTD_DIR      = DATA_DIR / "ctd"
+CTD_PATTERNS = ["*.cnv", "*.csv"]
+CTD_CHUNK    = 200000 # rows held in memory at once
+DEPTH_BIN_M  = 0.5
+TIME_BIN_S   = 60     # used when a cast has no depth
+
 # Note that map keys are all lower case since they are cast as such in the func
 MASTER_MAP = {# identifiers / cruise metadata
               "unique id": "unique_id",
@@ -82,6 +113,36 @@ MASTER_MAP = {# identifiers / cruise metadata
               "notes": "Notes"
               }
 
+# Cast column names (lower case) to db names, SeaBird short names included
+CTD_MAP = {"depsm":             "depth_m",
+           "depth":             "depth_m",
+           "depth (m)":         "depth_m",
+           "depth m":           "depth_m",
+           "prdm":              "pressure_db",
+           "pressure (db)":     "pressure_db",
+           "times":             "elapsed_s",
+           "time (s)":          "elapsed_s",
+           "t090c":             "Temp_C",
+           "tv290c":            "Temp_C",
+           "temp (c)":          "Temp_C",
+           "temp °c":           "Temp_C",
+           "sal00":             "Salinity_PSU",
+           "sal psu":           "Salinity_PSU",
+           "salinity (psu)":    "Salinity_PSU",
+           "sbeox0mg/l":        "DO_mg_L",
+           "odo mg/l":          "DO_mg_L",
+           "do (mg/l)":         "DO_mg_L",
+           "sbeox0ps":          "DO_percent",
+           "odo % sat":         "DO_percent",
+           "do (%)":            "DO_percent",
+           "specc":             "Conductivity_SPC_uS_cm",
+           "spcond µs/cm":      "Conductivity_SPC_uS_cm",
+           "conductivity (spc)": "Conductivity_SPC_uS_cm",
+           "ph":                "pH",
+           "flecostar":         "Chla_ug_L",
+           "chlorophyll ug/l":  "Chla_ug_L"
+           }
+
 STATION_MAP = {"station id":                "station_id",
                "off shore sites":           "station_id",
                "latitude":                  "latitude",
@@ -100,10 +161,12 @@ DTYPES = {# identifiers
           "year":      int,
           
           # time
-          "date":       str,
-          "time_local": str,
-          "time_utc":   str,
-          "datetime":   str,
+          "date":           str,
+          "time_local":     str,
+          "time_utc":       str,
+          "datetime":       str,
+          "epoch":          int,
+          "utc_offset_min": int,
           
           # station / location
           "station_id":         str,
@@ -126,10 +189,10 @@ DTYPES = {# identifiers
           
           # physical
           "Temp_C":                 float,
-          "DO_%":                   float,
+          "DO_percent":             float,
           "DO_mg_L":                float,
           "Salinity_PSU":           float,
-          "Conductivity_SPC_µS_cm": float,
+          "Conductivity_SPC_uS_cm": float,
           "pH":                     float,
           
           # carbon
@@ -150,14 +213,65 @@ DTYPES = {# identifiers
           "TDP_uM": float,
           
           # other
+          "Chla_ug_l": float,
           "Chla_ug_L": float,
           "TSS_mg_L":  float,
           
+          # station matching
+          "matched_station_id": str,
+          "station_distance_m": float,
+          "location_flag":      str,
+          
           # misc
           "Notes":       str,
           "source_file": str
           }   
 
+# Column names as loader() leaves them, rules are keyed on these
+def clean_name(name):
+    name = re.sub(r"[^a-zA-Z0-9_]", "_", name)
+    return re.sub(r"_+", "_", name).strip("_")
+LOADED_COLUMNS = sorted({clean_name(col) for col in
+                         list(MASTER_MAP.values()) + list(STATION_MAP.values())})
+
+# Max distance (m) for a sample position to count as taken at a station
+STATION_TOL_M  = 500
+EARTH_RADIUS_M = 6371008.8
+
+# QC: physical ranges (lo, hi) for float DTYPES columns, anything not listed
+# here must be non-negative. Location/depth columns aren't QC'd.
+RANGE_OVERRIDES = {"Temp_C":                 (-2, 40),
+                   "DO_percent":             (0, 250),
+                   "DO_mg_L":                (0, 25),
+                   "Salinity_PSU":           (0, 42),
+                   "Conductivity_SPC_uS_cm": (0, 70000),
+                   "pH":                     (0, 14)}
+QC_SKIP     = {"latitude", "longitude", "latitude_intended", "longitude_intended",
+               "measurement_depth_m", "secchi_depth_m", "sonar_depth_m",
+               "ave_depth_model_m", "station_distance_m"}
+RANGE_RULES = {col: RANGE_OVERRIDES.get(col, (0, np.inf))
+               for col in LOADED_COLUMNS + list(CTD_MAP.values())
+               if DTYPES.get(col) is float and col not in QC_SKIP}
+QC_Z      = 5      # robust z-score beyond which a value is an outlier
+QC_MIN_N  = 8      # values needed in a station-month before outliers are flagged
+MAD_SCALE = 1.4826 # MAD to standard deviation for normal data
+
+# Load time validation, every column the loader produces is type checked (str
+# when DTYPES doesn't know it). Ranges default to the QC ranges, region bounds
+# catch swapped lat/lon.
+LAT_BOUNDS = (20, 35)    # northern Gulf of Mexico
+LON_BOUNDS = (-100, -80)
+VALIDATION_RULES = {col: {"type": DTYPES.get(col, str)} for col in LOADED_COLUMNS}
+for col, bounds in RANGE_RULES.items():
+    VALIDATION_RULES.setdefault(col, {"type": float})["range"] = bounds
+for col in ["latitude", "latitude_intended"]:
+    VALIDATION_RULES[col]["range"] = LAT_BOUNDS
+for col in ["longitude", "longitude_intended"]:
+    VALIDATION_RULES[col]["range"] = LON_BOUNDS
+VALIDATION_RULES["year"]["range"]     = (1990, 2100)
+VALIDATION_RULES["layer"]["allowed"]  = ["S", "M", "B"]
+VALIDATION_RULES["measurement_depth_m"]["range"] = (0, 500)
+
 ##-----------------------------------------------------------------------------
 # Check if there are some inconsistencies in the columns
 def check_columns_consistency(data_dir, sheet_filter=lambda s: True, rename_map=None,name=None):
@@ -228,9 +342,68 @@ def enforce_dtypes(df, dtypes_map):
                 df[col] = df[col].astype(dtype)
     return df
 
+##-----------------------------------------------------------------------------
+## Validation
+def validate(df, sheet):
+    """
+    Parameters:
+    - df: sheet straight out of loader (raw values, -999999 for blanks)
+    - sheet: sheet name for the report
+    Checks every VALIDATION_RULES column at once and returns one row per bad
+    cell: source_file, sheet, row (excel row), column, raw_value, rule.
+    Rules are type (not a number), range, allowed and swapped (lat/lon).
+    """
+    rules   = {c: r for c, r in VALIDATION_RULES.items() if c in df.columns}
+    num     = [c for c, r in rules.items() if r["type"] in (int, float)]
+    raw     = df[list(rules)].astype("object")
+    missing = raw.isna() | raw.isin([-999999, "-999999", ""])
+    
+    # Numeric columns in one go
+    vals = df[num].apply(pd.to_numeric, errors="coerce")
+    lo   = pd.Series({c: rules[c].get("range", (-np.inf, np.inf))[0] for c in num}, dtype=float)
+    hi   = pd.Series({c: rules[c].get("range", (-np.inf, np.inf))[1] for c in num}, dtype=float)
+    bad_type  = vals.isna() & ~missing[num]
+    bad_range = (vals.lt(lo, axis=1) | vals.gt(hi, axis=1)) & ~missing[num]
+    
+    # Categories
+    cats    = [c for c, r in rules.items() if "allowed" in r]
+    bad_cat = pd.DataFrame({c: ~raw[c].astype(str).str.strip().isin(rules[c]["allowed"]) & ~missing[c]
+                            for c in cats}, index=df.index)
+    
+    # Lat/lon the wrong way round, both fall in each other's bounds
+    swapped = pd.Series(False, index=df.index)
+    if {"latitude", "longitude"}.issubset(vals.columns):
+        swapped = (vals["latitude"].between(*LON_BOUNDS) & vals["longitude"].between(*LAT_BOUNDS))
+    
+    # Most specific rule wins per cell
+    rule = pd.DataFrame("", index=df.index, columns=list(rules))
+    if num:
+        rule[num] = np.where(bad_range, "range", "")
+        rule[num] = np.where(bad_type, "type", rule[num])
+    if cats:
+        rule[cats] = np.where(bad_cat, "allowed", rule[cats])
+    for c in ["latitude", "longitude"]:
+        if c in rule.columns:
+            rule[c] = np.where(swapped, "swapped", rule[c])
+    
+    found = rule.stack()
+    found = found[found != ""]
+    if found.empty:
+        return pd.DataFrame(columns=["source_file", "sheet", "row", "column", "raw_value", "rule"])
+    rows, cols = found.index.get_level_values(0), found.index.get_level_values(1)
+    out = pd.DataFrame({"source_file": df["source_file"].iat[0],
+                        "sheet":       sheet,
+                        "row":         df.index.get_indexer(rows) + 2, # header is row 1
+                        "column":      cols,
+                        "raw_value":   raw.stack().reindex(found.index).astype(str).to_numpy(),
+                        "rule":        found.to_numpy()})
+    print(f"{len(out)} validation issues in {out['source_file'].iat[0]}::{sheet}")
+    return out
+
 # Initialize empty lists
 all_master_rows  = []
 all_station_rows = []
+all_violations   = []
 
 for xlsx in DATA_DIR.glob("**/*.xlsx"):
     # Load xlsx
@@ -243,21 +416,23 @@ for xlsx in DATA_DIR.glob("**/*.xlsx"):
     # Load station data
     for sheet in station_sheets:
         df = loader(xlsx,sheet,STATION_MAP)
+        all_violations.append(validate(df, sheet))
         all_station_rows.append(df)
 
     # Load WQ data
     for sheet in master_sheets:
         df = loader(xlsx,sheet,MASTER_MAP)
+        all_violations.append(validate(df, sheet))
         # Fix weird time artifacting
         df["time_local"] = df["time_local"].astype(str).str[:5]        
-        # Combine datetime and move new column after time column
-        df.insert(df.columns.get_loc("time_local") + 1,
-                  "datetime",
-                  pd.to_datetime(df["date"].astype(str).str.strip() + " " + df["time_local"].astype(str).str.strip(),
-                                 errors="coerce"
-                                 ).dt.strftime("%Y-%m-%d %H:%M:%S") 
-                  )
-        df["datetime"] = df["datetime"].fillna("")
+        # Combine datetime, formats detected once per sheet
+        stamps         = parse_datetime(df["date"], df["time_local"])
+        epoch, offset  = to_epoch(stamps)
+        # Move new columns after time column
+        loc = df.columns.get_loc("time_local")
+        df.insert(loc + 1, "datetime", to_text(stamps))
+        df.insert(loc + 2, "epoch", epoch)
+        df.insert(loc + 3, "utc_offset_min", offset)
           
         all_master_rows.append(df)
       
@@ -265,6 +440,105 @@ for xlsx in DATA_DIR.glob("**/*.xlsx"):
 master_df  = pd.concat(all_master_rows, ignore_index=True)
 station_df = (pd.concat(all_station_rows, ignore_index=True)
               .drop_duplicates(subset=["station_id"]))
+violations = pd.concat(all_violations, ignore_index=True)
+
+##-----------------------------------------------------------------------------
+## Spatial station matching
+# BallTree over station positions, pickled next to the db and rebuilt only
+# when the stations change
+STATION_INDEX_PATH = Path("WQ_stations.pkl")
+
+# Pull a lat/lon column as float degrees with sentinels and junk as NaN
+def get_coord(df, col, limit):
+    if col not in df.columns:
+        return pd.Series(np.nan, index=df.index)
+    vals = pd.to_numeric(df[col], errors="coerce")
+    return vals.where(vals.abs() <= limit)
+
+def build_station_index(stations):
+    """
+    Parameters:
+    - stations: DataFrame with station_id, latitude and longitude columns
+    Returns (BallTree, station_ids) using the haversine metric. The tree is
+    pickled to STATION_INDEX_PATH with a hash of the station coordinates and
+    reused by later runs while the hash matches.
+    """
+    lat  = get_coord(stations, "latitude", 90)
+    lon  = get_coord(stations, "longitude", 180)
+    ok   = lat.notna() & lon.notna()
+    pos  = pd.DataFrame({"station_id": stations["station_id"].astype(str).str.strip(),
+                         "latitude": lat, "longitude": lon})[ok]
+    key  = hashlib.sha1(pd.util.hash_pandas_object(pos, index=False).values).hexdigest()
+    if STATION_INDEX_PATH.exists():
+        try:
+            with open(STATION_INDEX_PATH, "rb") as f:
+                cached = pickle.load(f)
+            if cached["key"] == key:
+                return cached["tree"], cached["ids"]
+        except Exception as e:
+            print(f"Could not read {STATION_INDEX_PATH}, rebuilding: {e}")
+    coords = np.radians(pos[["latitude", "longitude"]].to_numpy())
+    tree   = BallTree(coords, metric="haversine") if len(pos) else None
+    ids    = pos["station_id"].to_numpy()
+    with open(STATION_INDEX_PATH, "wb") as f:
+        pickle.dump({"key": key, "tree": tree, "ids": ids}, f)
+    print("Rebuilt station index.")
+    return tree, ids
+
+# Great circle distance (m) between arrays of points in degrees
+def haversine_m(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = (np.sin((lat2 - lat1) / 2)**2 +
+         np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2)**2)
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+def match_stations(df, stations, tol_m=STATION_TOL_M):
+    """
+    Parameters:
+    - df: data rows with measured latitude/longitude
+    - stations: station table used to build the index
+    - tol_m: max distance (m) to the nearest station or intended position
+    Adds matched_station_id, station_distance_m and location_flag. Flags are
+    no_fix, off_station (nothing within tol_m), station_mismatch (nearest
+    station is not station_id) and off_intended (measured position is more
+    than tol_m from the intended one).
+    """
+    tree, ids = build_station_index(stations)
+    if tree is None:
+        print("No station coordinates available, skipping station matching.")
+        return df
+    
+    df      = df.copy()
+    lat     = get_coord(df, "latitude", 90)
+    lon     = get_coord(df, "longitude", 180)
+    has_fix = (lat.notna() & lon.notna()).to_numpy()
+    
+    # Nearest station for every row with a position, one bulk query
+    dist    = np.full(len(df), np.nan)
+    nearest = np.full(len(df), "", dtype=object)
+    if has_fix.any():
+        d, i = tree.query(np.radians(np.column_stack([lat[has_fix], lon[has_fix]])), k=1)
+        dist[has_fix]    = d[:, 0] * EARTH_RADIUS_M
+        nearest[has_fix] = ids[i[:, 0]]
+    within = dist <= tol_m
+    
+    # Offset from the intended position
+    off = haversine_m(lat.to_numpy(), lon.to_numpy(),
+                      get_coord(df, "latitude_intended", 90).to_numpy(),
+                      get_coord(df, "longitude_intended", 180).to_numpy())
+    
+    station = df["station_id"].astype(str).str.strip().to_numpy()
+    df["matched_station_id"] = np.where(within, nearest, "")
+    df["station_distance_m"] = np.where(has_fix, dist, -999999)
+    df["location_flag"]      = np.select([~has_fix, ~within, nearest != station, off > tol_m],
+                                         ["no_fix", "off_station", "station_mismatch", "off_intended"],
+                                         default="")
+    flagged = (df["location_flag"] != "").sum()
+    print(f"Matched {within.sum()} of {len(df)} rows to stations, {flagged} flagged.")
+    return df
+
+# Link sample positions to stations
+master_df = match_stations(master_df, station_df)
 
 # Enforce dtypes
 master_df = enforce_dtypes(master_df, DTYPES)
@@ -272,33 +546,93 @@ master_df = enforce_dtypes(master_df, DTYPES)
 ## Key functions
 def normalize(df):
     df = df.copy()
-    if "datetime" in df.columns:
-        df["datetime"] = pd.to_datetime(df["datetime"], errors="coerce").dt.strftime("%Y-%m-%d %H:%M:%S")
+    # datetime is already canonical text from wqtime, no re-parse
     if "station_id" in df.columns:
         df["station_id"] = df["station_id"].astype(str).str.strip()
     df = df.fillna(-999999)
     return df
 
-def upsert_dataframe(df, conn, table_name, key_cols, interactive_dupes=True):
+# Text columns hold the sentinel as a string after enforce_dtypes
+SENTINELS = [-999999, "-999999", ""]
+
+# Count of real (non-sentinel, non-empty) values in each row
+def row_completeness(df):
+    return (df.notna() & ~df.isin(SENTINELS)).sum(axis=1)
+
+def resolve_duplicates(df, conn, table_name, key_cols, policy):
+    """
+    Parameters:
+    - df: normalized DataFrame about to be upserted
+    - conn: open connection, conflicting rows go to duplicates_quarantine
+    - table_name: target table, recorded with the quarantined rows
+    - key_cols: columns that must be unique
+    - policy: one of
+        keep_first, keep_last: keep the first/last row of each duplicate key
+        keep_most_complete:    keep the row with the most non-missing values
+        merge:                 first non-missing value per column across rows
+        reject_file:           drop every row from the source files involved
+        ask:                   prompt on the console, abort on "n"
+    Every run re-reads all workbooks, so the quarantine for table_name is
+    replaced rather than appended to, dupes fixed in the sheets drop out.
+    """
+    if policy not in DUPE_POLICIES:
+        raise ValueError(f"Unsupported duplicate policy: {policy}")
+    if inspect(conn).has_table("duplicates_quarantine"):
+        conn.execute(text("DELETE FROM duplicates_quarantine WHERE table_name = :t"), {"t": table_name})
+    dupe_mask = df.duplicated(subset=key_cols, keep=False)
+    if not dupe_mask.any():
+        return df
+    dups = df[dupe_mask]
+    print(f"\nWARNING: Found {len(dups)} duplicate rows in {table_name} based on {', '.join(key_cols)}!")
+    
+    if policy == "ask":
+        print(dups.sort_values(key_cols))
+        while True:
+            choice = input("\nKeep only the first of each duplicate and continue? (y/n): ").strip().lower()
+            if choice in ["y", "n"]:
+                break
+            print("Please enter 'y' or 'n'.")
+        if choice == "n":
+            raise ValueError("Aborted by user due to duplicate rows. Resolve dupes and rerun.")
+        policy = "keep_first"
+    
+    # Park the conflicting rows for review, schema-free so any table fits
+    quarantine = pd.DataFrame({"table_name": table_name,
+                               "key": dups[key_cols].astype(str).agg("|".join, axis=1),
+                               "policy": policy,
+                               "quarantined_at": pd.Timestamp.now().strftime("%Y-%m-%d %H:%M:%S"),
+                               "row_json": dups.to_json(orient="records", lines=True).splitlines()})
+    quarantine.to_sql("duplicates_quarantine", conn, if_exists="append", index=False)
+    
+    if policy == "keep_first":
+        df = df.drop_duplicates(subset=key_cols, keep="first")
+    elif policy == "keep_last":
+        df = df.drop_duplicates(subset=key_cols, keep="last")
+    elif policy == "keep_most_complete":
+        order = row_completeness(df).sort_values(ascending=False, kind="stable").index
+        df    = df.loc[order].drop_duplicates(subset=key_cols, keep="first").sort_index()
+    elif policy == "merge":
+        values        = [c for c in df.columns if c not in key_cols]
+        blank         = df.copy()
+        blank[values] = df[values].mask(df[values].isin(SENTINELS))
+        fill = {c: -999999 if pd.api.types.is_numeric_dtype(df[c]) else "-999999"
+                for c in values}
+        df = (blank.groupby(key_cols, sort=False, as_index=False, dropna=False)
+              .first()[df.columns].fillna(fill))
+    elif "source_file" in df.columns: # reject_file
+        bad = dups["source_file"].unique()
+        df  = df[~df["source_file"].isin(bad)]
+        print(f"Rejected rows from: {', '.join(map(str, bad))}")
+    else:
+        df = df[~dupe_mask]
+    print(f"Resolved duplicates with {policy}, {len(dups)} rows quarantined. Proceeding with {len(df)} rows.")
+    return df
+
+# Returns the new or changed rows and the DB values they replaced
+def upsert_dataframe(df, conn, table_name, key_cols, dupe_policy=DUPE_POLICY):
     df = normalize(df)
     # Handle duplicates within the input DataFrame
-    if interactive_dupes:
-        dup_check = df[df.duplicated(subset=key_cols, keep=False)]
-        if not dup_check.empty:
-            print(f"\nWARNING: Found {len(dup_check)} duplicate rows based on {', '.join(key_cols)}!")
-            print(dup_check.sort_values(key_cols))
-            
-            while True:
-                choice = input("\nKeep only the first of each duplicate and continue? (y/n): ").strip().lower()
-                if choice in ["y", "n"]:
-                    break
-                print("Please enter 'y' or 'n'.")
-            
-            if choice == "y":
-                df = df.drop_duplicates(subset=key_cols, keep="first")
-                print(f"Duplicates removed. Proceeding with {len(df)} rows.")
-            else:
-                raise ValueError("Aborted by user due to duplicate rows. Resolve dupes and rerun.")
+    df = resolve_duplicates(df, conn, table_name, key_cols, dupe_policy)
     
     # Create table if it doesn't exist
     inspector = inspect(conn)
@@ -310,7 +644,13 @@ def upsert_dataframe(df, conn, table_name, key_cols, interactive_dupes=True):
                               ux_{table_name}_{'_'.join(key_cols)}
                               ON {table_name} ({idx_cols})"""))
         print(f"Inserted {len(df)} rows into new {table_name} table.")
-        return
+        return df, df.iloc[:0]
+    
+    # Add schema columns the table predates (e.g. epoch) so they aren't dropped
+    db_cols = {c["name"] for c in inspector.get_columns(table_name)}
+    for col in [c for c in df.columns if c in DTYPES and c not in db_cols]:
+        sql_type = {int: "INTEGER", float: "REAL"}.get(DTYPES[col], "TEXT")
+        conn.execute(text(f'ALTER TABLE {table_name} ADD COLUMN "{col}" {sql_type}'))
     
     # Compare with existing DB to find new or changed rows
     existing_df  = pd.read_sql(f"SELECT * FROM {table_name}", conn)
@@ -334,10 +674,13 @@ def upsert_dataframe(df, conn, table_name, key_cols, interactive_dupes=True):
 
     # Get new_or_changed rows from merged, not df
     new_or_changed = merged.loc[changed_mask, df.columns]
+    # Values being overwritten, lets the parquet export clear old partitions
+    replaced = (merged.loc[changed_mask, [f"{c}_db" for c in non_key_cols]]
+                .rename(columns=lambda c: c[:-3]))
     
     if new_or_changed.empty:
         print(f"No new or changed rows detected in {table_name}. Database is up-to-date.")
-        return
+        return new_or_changed, replaced
     
     # Upsert only new or changed rows
     insert_cols   = ", ".join(new_or_changed.columns)
@@ -351,12 +694,474 @@ def upsert_dataframe(df, conn, table_name, key_cols, interactive_dupes=True):
     
     conn.execute(upsert_sql, new_or_changed.to_dict(orient="records"))
     print(f"\nUpserted {len(new_or_changed)} new or changed rows into {table_name} table.")
+    return new_or_changed, replaced
+
+##-----------------------------------------------------------------------------
+## Parquet export
+# Arrow needs one type per column, text columns can hold -999999 ints
+def arrow_ready(df):
+    df  = enforce_dtypes(df, DTYPES)
+    obj = df.select_dtypes(include="object").columns
+    df[obj] = df[obj].astype("string")
+    return df
+
+def export_parquet(changed, conn, table_name, partition_cols=None, replaced=None):
+    """
+    Parameters:
+    - changed: change set returned by upsert_dataframe
+    - conn: connection the upsert ran on (sees the uncommitted rows)
+    - table_name: table to mirror under PARQUET_DIR
+    - partition_cols: hive partitions, None writes a single file
+    - replaced: DB values the change set overwrote (from upsert_dataframe)
+    Only partitions touched by the change set (new values and the values they
+    replaced) are rewritten, a missing export is built in full.
+    """
+    if pa is None:
+        print("pyarrow not installed, skipping parquet export.")
+        return
+    root  = PARQUET_DIR / table_name
+    fresh = not root.exists()
+    if not fresh and (changed is None or changed.empty):
+        return
+    
+    # Small tables are rewritten whole
+    if not partition_cols:
+        root.mkdir(parents=True, exist_ok=True)
+        df = arrow_ready(pd.read_sql(f"SELECT * FROM {table_name}", conn))
+        pq.write_table(pa.Table.from_pandas(df, preserve_index=False), root / f"{table_name}.parquet")
+        print(f"Exported {len(df)} rows of {table_name} to parquet.")
+        return
+    
+    # Pull every row of the touched partitions, the outer partition is enough
+    # to catch all rows since inner partitions get rewritten with it
+    outer = partition_cols[0]
+    if fresh:
+        df      = arrow_ready(pd.read_sql(f"SELECT * FROM {table_name}", conn))
+        touched = df[outer].unique()
+    else:
+        # Rows that moved partition leave their old value in replaced
+        touched = set(changed[outer].dropna())
+        if replaced is not None and outer in replaced.columns:
+            touched |= set(replaced[outer].dropna())
+        touched = sorted(v.item() if hasattr(v, "item") else v for v in touched)
+        params  = {f"p{i}": v for i, v in enumerate(touched)}
+        in_list = ", ".join(f":{k}" for k in params)
+        df = arrow_ready(pd.read_sql(text(f"SELECT * FROM {table_name} WHERE {outer} IN ({in_list})"),
+                                     conn, params=params))
+        # Clear the whole outer partitions so emptied inner ones go too
+        for v in touched:
+            shutil.rmtree(root / f"{outer}={v}", ignore_errors=True)
+    if df.empty:
+        return
+    pq.write_to_dataset(pa.Table.from_pandas(df, preserve_index=False), root,
+                        partition_cols=partition_cols,
+                        existing_data_behavior="overwrite_or_ignore")
+    print(f"Exported {len(df)} rows of {table_name} to parquet ({outer}: {', '.join(map(str, touched))}).")
+
+##-----------------------------------------------------------------------------
+## QC flagging
+# Insert or replace rows by key, creating the table and its unique index once
+def replace_rows(df, conn, table_name, key_cols):
+    if df.empty:
+        return
+    if not inspect(conn).has_table(table_name):
+        df.head(0).to_sql(table_name, conn, index=False)
+        conn.execute(text(f"""CREATE UNIQUE INDEX IF NOT EXISTS
+                              ux_{table_name}_{'_'.join(key_cols)}
+                              ON {table_name} ({', '.join(key_cols)})"""))
+    cols = ", ".join(df.columns)
+    vals = ", ".join(f":{c}" for c in df.columns)
+    conn.execute(text(f"INSERT OR REPLACE INTO {table_name} ({cols}) VALUES ({vals})"),
+                 df.to_dict(orient="records"))
+
+# Change set to long (station, time, layer, month, variable, value) rows
+def qc_long(df):
+    variables = [c for c in RANGE_RULES if c in df.columns]
+    keys      = ["station_id", "datetime", "layer"]
+    df        = df[keys + variables + [c for c in ["epoch", "utc_offset_min"] if c in df.columns]].copy()
+    if "epoch" in df.columns:
+        df["month"] = from_epoch(df["epoch"], df["utc_offset_min"]).dt.month
+    else:
+        df["month"] = pd.to_datetime(df["datetime"], errors="coerce").dt.month
+    long = df.melt(id_vars=keys + ["month"], value_vars=variables,
+                   var_name="variable", value_name="value")
+    long["value"] = pd.to_numeric(long["value"], errors="coerce")
+    long = long[long["value"].notna() & long["value"].ne(-999999)]
+    long["month"] = long["month"].fillna(-999999).astype(int)
+    return long
+
+def qc_flag(long, conn, rows):
+    """
+    Parameters:
+    - long: output of qc_long
+    - conn: open connection, reads climatology and writes qc_flags
+    - rows: data keys of the reloaded rows
+    Flags values outside RANGE_RULES ("range") and values more than QC_Z
+    robust z-scores from their station-month median ("outlier"). Only the
+    small climatology table is read, never the data history.
+    Returns the long frame with flag and z columns.
+    """
+    keys = ["station_id", "month", "variable"]
+    if inspect(conn).has_table("climatology"):
+        clim = pd.read_sql("SELECT station_id, month, variable, n, median, mad FROM climatology", conn)
+        long = long.merge(clim, on=keys, how="left")
+    else:
+        long = long.assign(n=0, median=np.nan, mad=np.nan)
+    
+    lo = long["variable"].map({k: v[0] for k, v in RANGE_RULES.items()})
+    hi = long["variable"].map({k: v[1] for k, v in RANGE_RULES.items()})
+    spread       = (MAD_SCALE * long["mad"]).where(long["mad"] > 0)
+    long["z"]    = (long["value"] - long["median"]).abs() / spread
+    out_of_range = (long["value"] < lo) | (long["value"] > hi)
+    outlier      = (long["n"].fillna(0) >= QC_MIN_N) & (long["z"] > QC_Z)
+    long["flag"] = np.select([out_of_range, outlier], ["range", "outlier"], default="")
+    
+    # Clear old flags for reloaded rows, then write the new ones
+    if inspect(conn).has_table("qc_flags") and not rows.empty:
+        conn.execute(text("""DELETE FROM qc_flags WHERE station_id = :station_id
+                             AND datetime = :datetime AND layer = :layer"""),
+                     rows.to_dict(orient="records"))
+    flags = long.loc[long["flag"] != "", ["station_id", "datetime", "layer", "variable",
+                                          "value", "flag", "z"]]
+    replace_rows(flags.fillna({"z": -999999}), conn, "qc_flags",
+                 ["station_id", "datetime", "layer", "variable"])
+    print(f"QC flagged {(long['flag'] == 'range').sum()} out of range and "
+          f"{(long['flag'] == 'outlier').sum()} outlier values.")
+    return long
+
+# "a IN (:a0, ...) AND b IN (...)" over the distinct values of each column,
+# callers merge the result back onto the exact combinations
+def in_filter(df, cols):
+    lists  = {k: [v.item() if hasattr(v, "item") else v for v in df[k].unique()] for k in cols}
+    where  = " AND ".join(f"{k} IN ({', '.join(f':{k}{i}' for i in range(len(v)))})"
+                          for k, v in lists.items())
+    params = {f"{k}{i}": x for k, v in lists.items() for i, x in enumerate(v)}
+    return where, params
+
+def update_climatology(long, conn, rows):
+    """
+    Parameters:
+    - long: output of qc_flag
+    - conn: open connection
+    - rows: data keys of the reloaded rows
+    Replaces the reloaded rows' entries in climatology_values with their
+    in-range values, so superseded, missing or out of range values drop out,
+    and recomputes median/MAD for the station-months touched before or after.
+    """
+    keys     = ["station_id", "month", "variable"]
+    row_keys = ["station_id", "datetime", "layer"]
+    good = long[(long["flag"] != "range") & (long["month"] != -999999)]
+    
+    # Groups the reloaded rows used to count in, then drop their old values
+    touched = good[keys]
+    if inspect(conn).has_table("climatology_values") and not rows.empty:
+        where, params = in_filter(rows, ["station_id", "datetime"])
+        old = pd.read_sql(text(f"""SELECT station_id, datetime, layer, month, variable
+                                   FROM climatology_values WHERE {where}"""), conn, params=params)
+        old = old.merge(rows, on=row_keys)
+        touched = pd.concat([touched, old[keys]])
+        conn.execute(text("""DELETE FROM climatology_values WHERE station_id = :station_id
+                             AND datetime = :datetime AND layer = :layer"""),
+                     rows.to_dict(orient="records"))
+    touched = touched.drop_duplicates()
+    if touched.empty:
+        return
+    replace_rows(good[keys + ["datetime", "layer", "value"]], conn, "climatology_values",
+                 ["station_id", "datetime", "layer", "variable"])
+    
+    # Pull just the touched groups back out
+    where, params = in_filter(touched, keys)
+    vals = pd.read_sql(text(f"SELECT station_id, month, variable, value FROM climatology_values WHERE {where}"),
+                       conn, params=params)
+    vals = vals.merge(touched, on=keys)
+    
+    # Groups left with no values lose their stats
+    emptied = touched.merge(vals[keys].drop_duplicates(), on=keys, how="left", indicator=True)
+    emptied = emptied.loc[emptied["_merge"] == "left_only", keys]
+    if not emptied.empty and inspect(conn).has_table("climatology"):
+        conn.execute(text("""DELETE FROM climatology WHERE station_id = :station_id
+                             AND month = :month AND variable = :variable"""),
+                     emptied.to_dict(orient="records"))
+    if vals.empty:
+        return
+    
+    # Robust stats in one grouped pass
+    grouped = vals.groupby(keys)["value"]
+    vals["median"] = grouped.transform("median")
+    vals["dev"]    = (vals["value"] - vals["median"]).abs()
+    stats = (vals.groupby(keys)
+             .agg(n=("value", "size"), median=("median", "first"), mad=("dev", "median"))
+             .reset_index())
+    replace_rows(stats, conn, "climatology", keys)
+    print(f"Updated climatology for {len(stats)} station-month-variable groups.")
+
+def qc_load(changed, conn):
+    if changed is None or changed.empty:
+        return
+    rows = changed[["station_id", "datetime", "layer"]].drop_duplicates()
+    long = qc_flag(qc_long(changed), conn, rows)
+    update_climatology(long, conn, rows)
+
+##-----------------------------------------------------------------------------
+## Sample label index
+def update_sample_index(changed, conn):
+    """
+    Parameters:
+    - changed: change set returned by upsert_dataframe for data
+    - conn: open connection
+    Keeps sample_index (normalized unique_id -> station_id/datetime/layer,
+    see wqsamples) in step with data. Built in full the first time.
+    """
+    keys = ["station_id", "datetime", "layer"]
+    if "unique_id" not in {c["name"] for c in inspect(conn).get_columns("data")}:
+        return
+    if not inspect(conn).has_table("sample_index"):
+        changed = pd.read_sql("SELECT unique_id, station_id, datetime, layer FROM data", conn)
+    elif changed is None or changed.empty:
+        return
+    else:
+        # Drop entries of reloaded rows, their unique_id may have changed
+        conn.execute(text("""DELETE FROM sample_index WHERE station_id = :station_id
+                             AND datetime = :datetime AND layer = :layer"""),
+                     changed[keys].drop_duplicates().to_dict(orient="records"))
+    rows = index_rows(changed)
+    if rows.empty:
+        return
+    replace_rows(rows, conn, "sample_index", ["label_key"] + keys)
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_sample_index_label ON sample_index (label_key)"))
+    print(f"Indexed {len(rows)} sample labels.")
+
+##-----------------------------------------------------------------------------
+## CTD casts
+# Same column clean up as loader
+def clean_columns(cols):
+    cols = pd.Index(cols).astype(str).str.strip().str.lower()
+    cols = cols.map(lambda c: CTD_MAP.get(c, c))
+    return (cols.str.replace(r"[^a-zA-Z0-9_]", "_", regex=True)
+                .str.replace(r"_+", "_", regex=True)
+                .str.strip("_"))
+
+# SeaBird .cnv: names come from "# name i = short: long" lines, data after *END*
+def cnv_header(path):
+    names = []
+    with open(path, errors="ignore") as f:
+        for n, line in enumerate(f, 1):
+            if line.startswith("# name"):
+                names.append(line.split("=", 1)[1].split(":", 1)[0].strip())
+            elif line.startswith("*END*"):
+                return names, n
+    raise ValueError(f"No *END* header marker in {path}")
+
+# Yield numeric chunks of a cast file, never the whole file
+def ctd_chunks(path):
+    if path.suffix.lower() == ".cnv":
+        names, skip = cnv_header(path)
+        reader = pd.read_csv(path, sep=r"\s+", names=names, skiprows=skip,
+                             chunksize=CTD_CHUNK)
+    else:
+        reader = pd.read_csv(path, chunksize=CTD_CHUNK, encoding_errors="ignore")
+    for chunk in reader:
+        chunk.columns = clean_columns(chunk.columns)
+        chunk = chunk.loc[:, ~chunk.columns.duplicated()]
+        yield chunk.apply(pd.to_numeric, errors="coerce").astype("float64")
+
+# Cast ids from file names and master sheets, e.g. "CTD_012" and "12.0" -> "12"
+def ctd_key(values):
+    keys = pd.Series(values, dtype="string").str.strip().str.lower()
+    keys = keys.str.replace(r"^ctd[\s_#-]*", "", regex=True).str.replace(r"\.0$", "", regex=True)
+    digits = keys.str.fullmatch(r"\d+").fillna(False).astype(bool)
+    return keys.where(~digits, keys.str.lstrip("0").replace("", "0"))
+
+# CTD_number -> station_id/datetime from the master sheets, one row per cruise
+# since CTD #s get reused between cruises
+def ctd_links(master):
+    cols = ["CTD_number", "cruise_id", "station_id", "datetime"]
+    if "CTD_number" not in master.columns:
+        return pd.DataFrame(columns=["ctd_key"] + cols)
+    links = master.reindex(columns=cols).fillna({"cruise_id": "-999999"})
+    links["cruise_id"] = links["cruise_id"].astype(str).str.strip()
+    links["ctd_key"]   = ctd_key(links["CTD_number"]).to_numpy()
+    links = links[~links["ctd_key"].isin(["-999999", "", "nan", "<na>"]) & links["ctd_key"].notna()]
+    return links.sort_values("datetime").drop_duplicates(["ctd_key", "cruise_id"])
+
+# Master sheet row for a cast. A CTD # used on several cruises is narrowed to
+# the cruise named by one of the cast's folders, anything else is reported and
+# the cast stays unlinked.
+def link_cast(path, links):
+    rel   = path.relative_to(CTD_DIR)
+    cands = links[links["ctd_key"] == ctd_key([path.stem]).iat[0]]
+    if cands.empty:
+        print(f"No master sheet row with CTD # {path.stem}, {rel.as_posix()} stored unlinked.")
+        return cands
+    if len(cands) > 1:
+        folders = {p.strip().lower() for p in rel.parent.parts}
+        match   = cands[cands["cruise_id"].str.lower().isin(folders)]
+        if len(match) != 1:
+            print(f"CTD # {path.stem} is on cruises {', '.join(cands['cruise_id'])} and "
+                  f"{rel.as_posix()} isn't in a folder named for one of them, stored unlinked.")
+            return cands.iloc[:0]
+        cands = match
+    return cands
+
+def ingest_cast(path, links):
+    """
+    Parameters:
+    - path: cast file
+    - links: output of ctd_links
+    Casts are identified by their path under CTD_DIR, the same file name can
+    turn up in several cruise folders. Streams the file chunk by chunk: each chunk is appended to the raw
+    parquet file and reduced to per-bin sums/counts, so memory stays at one
+    chunk plus the bins. Returns the binned profile (means per bin).
+    """
+    sums, counts, writer = None, None, None
+    rel = path.relative_to(CTD_DIR).as_posix()
+    raw = PARQUET_DIR / "ctd_raw" / f"{rel}.parquet"
+    try:
+        for chunk in ctd_chunks(path):
+            # Full resolution copy
+            if pa is not None:
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                if writer is None:
+                    raw.parent.mkdir(parents=True, exist_ok=True)
+                    writer = pq.ParquetWriter(raw, table.schema)
+                    schema = table.schema
+                writer.write_table(table.select(schema.names).cast(schema))
+            # Bin on depth, fall back to elapsed time
+            if "depth_m" in chunk.columns:
+                bins = (chunk["depth_m"] // DEPTH_BIN_M * DEPTH_BIN_M).rename("depth_bin_m")
+            elif "elapsed_s" in chunk.columns:
+                bins = (chunk["elapsed_s"] // TIME_BIN_S * TIME_BIN_S).rename("time_bin_s")
+            else:
+                raise ValueError(f"No depth or time column in {rel}")
+            grouped = chunk.groupby(bins)
+            part_s, part_c = grouped.sum(), grouped.count()
+            sums   = part_s if sums is None else sums.add(part_s, fill_value=0)
+            counts = part_c if counts is None else counts.add(part_c, fill_value=0)
+    finally:
+        if writer is not None:
+            writer.close()
+    if sums is None:
+        return pd.DataFrame()
+    
+    profile = (sums / counts.where(counts > 0)).reset_index()
+    profile.insert(1, "n", counts.max(axis=1).to_numpy().astype(int))
+    profile.insert(0, "source_file", rel)
+    link = link_cast(path, links)
+    for col, missing in [("CTD_number", path.stem), ("station_id", "-999999"), ("datetime", "")]:
+        profile[col] = link[col].iat[0] if len(link) else missing
+    return profile
+
+def load_ctd_casts(conn, master):
+    """
+    Parameters:
+    - conn: open connection
+    - master: master sheet rows, used to link casts to stations by CTD #
+    Loads new or modified cast files from CTD_DIR into ctd_profiles, files
+    seen before with the same size and mtime are skipped.
+    """
+    files = sorted(f for pattern in CTD_PATTERNS for f in CTD_DIR.glob(f"**/{pattern}"))
+    if not files:
+        return
+    seen = {}
+    if inspect(conn).has_table("ctd_files"):
+        seen = pd.read_sql("SELECT source_file, size, mtime FROM ctd_files", conn)
+        seen = {r.source_file: (r.size, r.mtime) for r in seen.itertuples()}
+    links = ctd_links(master)
+    
+    loaded = []
+    for path in files:
+        stat = path.stat()
+        rel  = path.relative_to(CTD_DIR).as_posix()
+        if seen.get(rel) == (stat.st_size, int(stat.st_mtime)):
+            continue
+        try:
+            profile = ingest_cast(path, links)
+        except Exception as e:
+            print(f"Error with CTD file {rel}: {e}")
+            continue
+        if profile.empty:
+            continue
+        
+        # Replace any earlier load of this file, widen the table for new sensors
+        if inspect(conn).has_table("ctd_profiles"):
+            conn.execute(text("DELETE FROM ctd_profiles WHERE source_file = :f"), {"f": rel})
+            db_cols = {c["name"] for c in inspect(conn).get_columns("ctd_profiles")}
+            for col in [c for c in profile.columns if c not in db_cols]:
+                sql_type = "REAL" if pd.api.types.is_float_dtype(profile[col]) else "TEXT"
+                conn.execute(text(f'ALTER TABLE ctd_profiles ADD COLUMN "{col}" {sql_type}'))
+        profile.to_sql("ctd_profiles", conn, if_exists="append", index=False)
+        loaded.append({"source_file": rel, "size": stat.st_size,
+                       "mtime": int(stat.st_mtime), "bins": len(profile)})
+    
+    if loaded:
+        replace_rows(pd.DataFrame(loaded), conn, "ctd_files", ["source_file"])
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_ctd_profiles_cast ON ctd_profiles (CTD_number)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_ctd_profiles_station ON ctd_profiles (station_id, datetime)"))
+    print(f"Loaded {len(loaded)} CTD casts, {len(files) - len(loaded)} unchanged or skipped.")
+
+##-----------------------------------------------------------------------------
+# Instrument results staged by wqsamples.attach_results fill the cells the
+# sheets leave blank, so they are upserted (and QC'd, exported, ...) with them
+def merge_results(df, conn, key_cols):
+    """
+    Parameters:
+    - df: normalized master rows about to be upserted
+    - conn: open connection
+    - key_cols: data key, the results table is keyed on it plus variable
+    Returns df with staged results filled in. Sheet values win, a result only
+    replaces a missing value, so a blank sheet cell never wipes a result.
+    """
+    if not inspect(conn).has_table(RESULTS_TABLE):
+        return df
+    res = pd.read_sql(f"SELECT {', '.join(key_cols)}, variable, value FROM {RESULTS_TABLE}", conn)
+    unknown = set(res["variable"]) - {c for c, t in DTYPES.items() if t is float}
+    if unknown:
+        print(f"Ignoring staged results for unknown columns: {', '.join(sorted(unknown))}")
+    res = res[~res["variable"].isin(unknown)]
+    if res.empty:
+        return df
+    
+    wide = res.pivot(index=key_cols, columns="variable", values="value")
+    rows = pd.MultiIndex.from_frame(df[key_cols].astype(str))
+    df   = df.copy()
+    filled = 0
+    for col in wide.columns:
+        vals = pd.Series(wide[col].reindex(rows).to_numpy(), index=df.index)
+        if col not in df.columns:
+            df[col] = -999999.0
+        fill = vals.notna() & (df[col].isna() | df[col].isin(SENTINELS))
+        df.loc[fill, col] = vals[fill]
+        filled += fill.sum()
+    print(f"Filled {filled} values from staged results.")
+    return df
 
 ##-----------------------------------------------------------------------------
 # Call funcs for upsert
 with engine.begin() as conn:
     # Upsert stations
-    upsert_dataframe(station_df, conn, table_name="stations", key_cols=["station_id"])
+    station_changes, _ = upsert_dataframe(station_df, conn, table_name="stations", key_cols=["station_id"])
+    
+    # Upsert master data, staged instrument results included. Normalized first
+    # so the keys match the stripped ones results were staged under
+    master_df    = merge_results(normalize(master_df), conn, ["station_id", "datetime", "layer"])
+    data_changes, data_replaced = upsert_dataframe(master_df, conn, table_name="data", key_cols=["station_id", "datetime", "layer"])
+    
+    # Sample label -> data key index for attaching instrument results
+    update_sample_index(data_changes, conn)
+    
+    # Validation report for this load, replaces the last one
+    violations.to_sql("violations", conn, if_exists="replace", index=False)
+    
+    # Raw CTD/sonde casts
+    load_ctd_casts(conn, master_df)
+    
+    # Flag new values and fold them into the climatology
+    qc_load(data_changes, conn)
+    
+    # Refresh the parquet copy from the change sets
+    export_parquet(station_changes, conn, "stations")
+    export_parquet(data_changes, conn, "data", partition_cols=PARQUET_PARTITIONS,
+                   replaced=data_replaced)
     
-    # Upsert master data
-    upsert_dataframe(master_df, conn, table_name="data", key_cols=["station_id", "datetime", "layer"])
+    # Index the typed timestamp for range queries
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_data_epoch ON data (epoch)"))
@@ -0,0 +1,130 @@
+import sqlite3
+import pandas as pd
+
+# Resolves free text sample labels (preprocessor 'Sample Name'/'SampleID',
+# olivia_bot 'Sample ID') to the (station_id, datetime, layer) key of the data
+# table. sqlitegen keeps a sample_index table of normalized unique_id labels
+# up to date, lookups here are a single merge against it. Resolved values are
+# staged in the results table, the next sqlitegen run merges them into data so
+# they go through QC, the parquet export and later reloads like sheet values.
+
+DB_PATH = "WQ.sqlite"
+KEYS    = ["station_id", "datetime", "layer"]
+RESULTS_TABLE = "results" # long: data key, variable, value, label
+
+# Applied in order to both sides, keep these to the lab's naming habits
+LABEL_RULES = [(r"\s+",                 ""),   # "MR 01" -> "MR01"
+               (r"[_./]",               "-"),  # "MR_01", "MR.01" -> "MR-01"
+               (r"-+",                  "-"),
+               (r"^-|-$",               ""),
+               (r"(?<![0-9])0+(?=[0-9])", ""), # "MR-01", "0012" -> "MR-1", "12"
+               (r"(?<=[A-Z])-(?=[0-9])", ""),  # "MR-1" -> "MR1"
+               ]
+
+# Instrument result columns (lower case) to data columns
+RESULT_MAP = {"conc. npoc": "NPOC_ppm",
+              "conc. doc":  "NPOC_ppm",
+              "doc":        "NPOC_ppm",
+              "conc. tn":   "TN_ppm",
+              "tn":         "TN_ppm",
+              "conc. dic":  "DIC_ppm",
+              "conc. ic":   "DIC_ppm",
+              "no3 no2":    "NO3_NO2_uM",
+              "no2":        "NO2_uM",
+              "nh4":        "NH4_uM",
+              "po4":        "PO4_uM",
+              "d si":       "DSi_uM"}
+
+def normalize_labels(labels):
+    keys = pd.Series(labels).astype("string").str.strip().str.upper()
+    keys = keys.str.replace(r"\.0$", "", regex=True) # labels read as floats
+    for pattern, repl in LABEL_RULES:
+        keys = keys.str.replace(pattern, repl, regex=True)
+    return keys
+
+def index_rows(df):
+    """
+    Parameters:
+    - df: data rows with unique_id and the data key columns
+    Returns sample_index rows: label_key, label and the data key.
+    """
+    if "unique_id" not in df.columns:
+        return pd.DataFrame(columns=["label_key", "label"] + KEYS)
+    rows = df[["unique_id"] + KEYS].rename(columns={"unique_id": "label"})
+    rows["label"]     = rows["label"].astype(str)
+    rows["label_key"] = normalize_labels(rows["label"]).to_numpy()
+    rows = rows[rows["label_key"].notna() & ~rows["label_key"].isin(["", "-999999", "NAN", "<NA>"])]
+    return rows[["label_key", "label"] + KEYS].drop_duplicates()
+
+def resolve(results, label_col="Sample Name", db_path=DB_PATH):
+    """
+    Parameters:
+    - results: instrument results, one row per sample
+    - label_col: column holding the sample label
+    - db_path: WQ.sqlite with a sample_index table (built by sqlitegen)
+    Returns (resolved, unresolved). resolved gets the data key columns,
+    unresolved has a reason column: "no match" or "ambiguous" (label maps to
+    more than one data row).
+    """
+    con   = sqlite3.connect(db_path)
+    index = pd.read_sql("SELECT label_key, station_id, datetime, layer FROM sample_index", con)
+    con.close()
+    
+    results = results.copy()
+    results["label_key"] = normalize_labels(results[label_col]).to_numpy()
+    hits    = index.groupby("label_key").size()
+    unique  = index[index["label_key"].map(hits) == 1]
+    
+    merged   = results.merge(unique, on="label_key", how="left", indicator=True)
+    resolved = merged[merged["_merge"] == "both"].drop(columns=["_merge", "label_key"])
+    unresolved = merged.loc[merged["_merge"] == "left_only", results.columns]
+    unresolved["reason"] = (unresolved["label_key"].map(hits).gt(1)
+                            .map({True: "ambiguous", False: "no match"}))
+    unresolved = unresolved.drop(columns="label_key")
+    print(f"Resolved {len(resolved)} of {len(results)} labels, "
+          f"{(unresolved['reason'] == 'ambiguous').sum()} ambiguous, "
+          f"{(unresolved['reason'] == 'no match').sum()} unmatched.")
+    return resolved, unresolved
+
+def attach_results(results, label_col="Sample Name", db_path=DB_PATH, column_map=RESULT_MAP):
+    """
+    Parameters:
+    - results: instrument results (e.g. preprocessor master.xlsx sheet)
+    - label_col: column holding the sample label
+    - db_path: WQ.sqlite
+    - column_map: result columns (lower case) to data columns
+    Resolves the labels and stages every mapped, non-missing value in the
+    results table in one transaction, replacing earlier values for the same
+    key and variable. Run sqlitegen afterwards to load them into data.
+    Returns the unresolved rows.
+    """
+    resolved, unresolved = resolve(results, label_col, db_path)
+    resolved = resolved.rename(columns=lambda c: column_map.get(str(c).strip().lower(), c))
+    resolved = resolved.loc[:, ~resolved.columns.duplicated()]
+    targets  = sorted(set(column_map.values()) & set(resolved.columns))
+    
+    staged = (resolved[KEYS + [label_col] + targets]
+              .rename(columns={label_col: "label"})
+              .melt(id_vars=KEYS + ["label"], var_name="variable", value_name="value"))
+    staged["value"] = pd.to_numeric(staged["value"], errors="coerce")
+    staged = staged[staged["value"].notna() & (staged["value"] != -999999)]
+    staged["label"] = staged["label"].astype(str)
+    
+    con = sqlite3.connect(db_path)
+    try:
+        with con:
+            con.execute(f"""CREATE TABLE IF NOT EXISTS {RESULTS_TABLE}
+                            (station_id TEXT, datetime TEXT, layer TEXT,
+                             variable TEXT, value REAL, label TEXT)""")
+            con.execute(f"""CREATE UNIQUE INDEX IF NOT EXISTS
+                            ux_{RESULTS_TABLE}_station_id_datetime_layer_variable
+                            ON {RESULTS_TABLE} (station_id, datetime, layer, variable)""")
+            cols = KEYS + ["variable", "value", "label"]
+            con.executemany(f"INSERT OR REPLACE INTO {RESULTS_TABLE} ({', '.join(cols)}) "
+                            f"VALUES ({', '.join('?' * len(cols))})",
+                            staged[cols].itertuples(index=False, name=None))
+    finally:
+        con.close()
+    for col, n in staged["variable"].value_counts().sort_index().items():
+        print(f"Staged {n} {col} values.")
+    return unresolved
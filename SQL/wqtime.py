@@ -0,0 +1,102 @@
+import pandas as pd
+
+# Shared datetime handling for the WQ pipeline. Formats are detected per column
+# from a small sample, the whole column is then parsed with that format.
+# WQ.sqlite keeps local wall time as text (key column) plus an integer UTC
+# epoch and the local offset so readers never have to parse strings.
+
+# Time zone the cruise sheets are recorded in
+LOCAL_TZ = "America/Chicago"
+
+# Candidates tried in order, first best match wins
+DATE_FORMATS = ["%Y-%m-%d %H:%M:%S",  # excel date cells cast to str
+                "%Y-%m-%d",
+                "%m/%d/%Y",
+                "%m/%d/%y",
+                "%Y/%m/%d",
+                "%d-%b-%Y"]
+TIME_FORMATS = ["%H:%M",
+                "%H:%M:%S",
+                "%I:%M %p",
+                "%H%M"]
+DATETIME_FORMATS = ["%Y-%m-%d %H:%M:%S",
+                    "%m/%d/%Y %I:%M:%S %p",
+                    "%Y/%m/%d %H:%M:%S"]
+TEXT_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+SAMPLE_SIZE = 50
+
+# Strip blanks and -999999 sentinels so they don't count against a format
+def clean_text(values):
+    text = values.astype(str).str.strip()
+    return text.where(~text.isin(["", "nan", "NaT", "None", "-999999", "-9999"]))
+
+def detect_format(values, formats):
+    """
+    Parameters:
+    - values: Series of date/time strings
+    - formats: candidate strftime formats
+    Returns the format that parses the most of a small sample, or None.
+    """
+    sample = clean_text(values).dropna().head(SAMPLE_SIZE)
+    best, hits = None, 0
+    for fmt in formats:
+        n = pd.to_datetime(sample, format=fmt, errors="coerce").notna().sum()
+        if n > hits:
+            best, hits = fmt, n
+    return best
+
+def parse_column(values, formats):
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    text = clean_text(values)
+    fmt  = detect_format(text, formats)
+    if fmt is None:
+        return pd.Series(pd.NaT, index=values.index, dtype="datetime64[ns]")
+    return pd.to_datetime(text, format=fmt, errors="coerce")
+
+def parse_datetime(date, time):
+    """
+    Parameters:
+    - date: Series of dates (strings, excel datetimes or sentinels)
+    - time: Series of local times
+    Returns a naive datetime64 Series of local wall time, NaT where either
+    part is missing.
+    """
+    days = parse_column(date, DATE_FORMATS).dt.normalize()
+    tod  = parse_column(time, TIME_FORMATS)
+    return days + (tod - tod.dt.normalize())
+
+def to_epoch(stamps, tz=LOCAL_TZ):
+    """
+    Parameters:
+    - stamps: naive datetime64 Series of local wall time
+    - tz: time zone the wall time was recorded in
+    Returns (epoch, utc_offset_min) as int64 Series, -999999 where missing.
+    """
+    local  = stamps.dt.tz_localize(tz, ambiguous="NaT", nonexistent="NaT")
+    utc    = local.dt.tz_convert(None)
+    ok     = utc.notna()
+    epoch  = pd.Series(-999999, index=stamps.index, dtype="int64")
+    offset = pd.Series(-999999, index=stamps.index, dtype="int64")
+    epoch[ok]  = utc[ok].astype("int64") // 10**9
+    offset[ok] = ((stamps[ok] - utc[ok]).dt.total_seconds() // 60).astype("int64")
+    return epoch, offset
+
+def from_epoch(epoch, utc_offset_min=None):
+    """
+    Parameters:
+    - epoch: integer seconds since 1970 UTC (-999999 or NaN when missing)
+    - utc_offset_min: optional local offset, returns local wall time if given
+    Returns a naive datetime64 Series.
+    """
+    epoch  = pd.to_numeric(epoch, errors="coerce")
+    stamps = pd.to_datetime(epoch.where(epoch != -999999), unit="s")
+    if utc_offset_min is not None:
+        offset = pd.to_numeric(utc_offset_min, errors="coerce")
+        offset = offset.where(offset != -999999).fillna(0)
+        stamps = stamps + pd.to_timedelta(offset, unit="m")
+    return stamps
+
+def to_text(stamps):
+    return stamps.dt.strftime(TEXT_FORMAT).fillna("")
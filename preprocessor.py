@@ -6,12 +6,156 @@ import numpy as np
 from sklearn.linear_model import LinearRegression
 import matplotlib.pyplot as plt
 import datetime as dt
+import re
 
 ## For my sanity
 pd.options.mode.copy_on_write = True
 ##-----------------------------------------------------------------------------
+## Instrument profiles
+# One entry per instrument export. Profiles are checked in order and the first
+# whose signature is found in the head of a file is used to read it.
+#   signature: regex searched for in the first lines of the file
+#   header:    row offset of the column names, 'match' for the row holding the
+#              signature, or 'numeric' for every row above the first numeric one
+#   encoding:  None to sniff from the byte order mark
+#   columns:   rename map applied after the read
+#   dtypes:    columns coerced after the read
+#   timeCol:   run timestamp column and the formats it may be written in
+#   standards: names/ids used for checks and drift, blank cutoff for empty vials
+INSTRUMENT_PROFILES = {
+    'TOC-L': {'signature': r'Spl\. No\.',
+              'header':    'match',
+              'delimiter': '\t',
+              'encoding':  None,
+              'columns':   {},
+              'dtypes':    {'Sample Name': str, 'Sample ID': str,
+                            'Spl. No.': int, 'Inj. No.': int,
+                            'Area': float, 'Conc.': float, 'Excluded': int},
+              'timeCol':   'Date / Time',
+              'timeFormats': ['%m/%d/%Y %I:%M:%S %p','%Y/%m/%d %H:%M:%S'],
+              'standards': {'checkNames':   ['QC','Q','L','H'],
+                            'checkIDsHigh': ['Spike','H'],
+                            'emptyVial':    1.5}},
+    'NUT':   {'signature': r'NeedleNumber',
+              'header':    'match',
+              'delimiter': '\t',
+              'encoding':  None,
+              'columns':   {},
+              'dtypes':    {'NO3 NO2': float, 'PO4': float, 'NO2': float,
+                            'NH4': float, 'D Si': float},
+              'standards': {}},
+    'PCN':   {'signature': r'\bNitrogen\b|\bCarbon\b',
+              'header':    'numeric',
+              'delimiter': ',',
+              'encoding':  None,
+              'columns':   {},
+              'dtypes':    {},
+              'standards': {}},
+    'Stations': {'signature': r'\bLine\b.*\bLetter\b',
+                 'header':    'match',
+                 'delimiter': ',',
+                 'encoding':  None,
+                 'columns':   {},
+                 'dtypes':    {'Number': str},
+                 'standards': {}},
+    }
+
+# Number of bytes (text) or rows (excel) looked at when matching a profile
+SNIFF_BYTES = 8192
+SNIFF_ROWS  = 20
+
+def compileProfile(name,profile):
+    compiled = dict(profile)
+    compiled['name']    = name
+    compiled['pattern'] = re.compile(profile['signature'])
+    compiled['numeric'] = [c for c,t in profile['dtypes'].items() if t in (int,float)]
+    compiled['text']    = [c for c,t in profile['dtypes'].items() if t is str]
+    return compiled
+
+# Compile once on import
+PROFILES = {k:compileProfile(k,v) for k,v in INSTRUMENT_PROFILES.items()}
+
+# Cheap look at the head of a file: returns reader kind, encoding and lines
+def sniff(inFile):
+    with open(inFile,'rb') as f:
+        head = f.read(SNIFF_BYTES)
+    if head.startswith((b'PK',b'\xd0\xcf\x11\xe0')): # xlsx / xls
+        preview = pd.read_excel(inFile,header=None,nrows=SNIFF_ROWS)
+        preview = preview.fillna('').astype(str) # keep blank rows, read_excel counts them
+        return 'excel', None, preview.agg('\t'.join,axis=1).tolist()
+    encoding = 'utf-16' if head.startswith((b'\xff\xfe',b'\xfe\xff')) else None
+    text     = head.decode(encoding or 'utf-8',errors='ignore')
+    lines    = text.splitlines() # raw lines, offsets become skiprows for read_csv
+    return 'text', encoding, lines[:-1] or lines # last line may be cut off
+
+# Pick the first profile found in the preview and resolve its header offset.
+# Text files skip raw lines explicitly (skiprows) so blank or delimiter only
+# lines can't shift the header the way pandas' blank line handling would.
+def matchProfile(inFile):
+    kind, encoding, lines = sniff(inFile)
+    for profile in PROFILES.values():
+        hits = [i for i,l in enumerate(lines) if profile['pattern'].search(l)]
+        if not hits:
+            continue
+        header, skip = profile['header'], None
+        if header == 'match':
+            header = hits[0]
+        elif header == 'numeric':
+            delim = '\t' if kind == 'excel' else profile['delimiter']
+            nums  = [i for i,l in enumerate(lines)
+                     if any(c.strip().isnumeric() for c in l.split(delim))]
+            first  = max(nums[0],1) if nums else 1
+            header = list(range(first))
+        if kind == 'text':
+            start  = header[0] if isinstance(header,list) else header
+            rows   = header if isinstance(header,list) else [header]
+            blank  = [i for i in rows if not lines[i].strip(' \t,;')]
+            skip   = list(range(start)) + blank
+            nhead  = len(rows) - len(blank)
+            header = list(range(nhead)) if nhead > 1 else 0
+        elif isinstance(header,list):
+            header = header if len(header) > 1 else 0
+        return profile, kind, encoding or profile['encoding'], header, skip
+    return None, kind, encoding, None, None
+
+# Pick the time format once from the first stamp then parse the column in one go
+def parseTimes(times,formats):
+    first = times.dropna().astype(str).str.strip()
+    for fmt in formats:
+        if first.empty or pd.notna(pd.to_datetime(first.iat[0],format=fmt,errors='coerce')):
+            return pd.to_datetime(times,format=fmt,errors='coerce')
+    return pd.to_datetime(times,errors='coerce')
+
+# One read per file using the matched profile
+def readProfile(inFile,profile,kind,encoding,header,skip):
+    if kind == 'excel':
+        df = pd.read_excel(inFile,header=header)
+    else:
+        df = pd.read_csv(inFile,delimiter=profile['delimiter'],header=header,
+                         skiprows=skip,encoding=encoding)
+    if isinstance(header,list): # flatten stacked header rows
+        df.columns = [' '.join(str(p).strip() for p in col
+                               if not str(p).startswith('Unnamed'))
+                      for col in df.columns]
+    df = df.rename(columns=lambda x: str(x).strip())
+    df = df.rename(columns=profile['columns'])
+    num = [c for c in profile['numeric'] if c in df.columns]
+    txt = [c for c in profile['text'] if c in df.columns]
+    if num:
+        df[num] = df[num].apply(pd.to_numeric,errors='coerce')
+    if txt:
+        df[txt] = df[txt].astype('string')
+    df.attrs['profile'] = profile['name']
+    return df
+##-----------------------------------------------------------------------------
 ## Move stuff around
 def pullIn(inFile):
+    profile, kind, encoding, header, skip = matchProfile(inFile)
+    if profile is not None:
+        df = readProfile(inFile,profile,kind,encoding,header,skip)
+        df.dropna(thresh=2,inplace=True) # cut rows with less than 2 values
+        return df
+    # Unrecognized export, fall back to guessing
     if inFile.endswith('.xls') or inFile.endswith('.xlsx'):
         df = pd.read_excel(inFile)
     else:
@@ -65,13 +209,40 @@ def buildFinal(inputDict,outpath):
 ## Add in R-squareds as proxy for QC
 ## Need function for PP cal curve
 
+# Run cleaning ported from DICTNDOC.m, masks over the Type/Anal./Spl. No. runs
+# in place of the row by row while loops
+def cleanRuns(df):
+    if not {'Type','Anal.','Spl. No.'}.issubset(df.columns):
+        return df
+    # Clean up blanks at start
+    df    = df[df['Type'].astype(str).str.strip().ne('Unknown').cummax()]
+    df    = df.reset_index(drop=True)
+    # Clean up standards that don't correspond to samples, i.e. drop through
+    # the first analyte change inside the leading block of standards
+    isStd = df['Type'].astype(str).str.strip().eq('Standard')
+    lead  = ~(~isStd).cummax()
+    anal  = df['Anal.']
+    cut   = lead & anal.ne(anal.shift(-1)) & anal.shift(-1).notna()
+    if cut.any():
+        df = df.iloc[cut.idxmax()+1:].reset_index(drop=True)
+    # Clean up failed standard runs, i.e. drop through the last point where
+    # Spl. No. resets between two standards in the leading block
+    isStd = df['Type'].astype(str).str.strip().eq('Standard')
+    lead  = ~(~isStd).cummax()
+    spl   = pd.to_numeric(df['Spl. No.'],errors='coerce')
+    reset = lead & spl.gt(spl.shift(-1)) & isStd.shift(-1,fill_value=False)
+    if reset.any():
+        df = df.iloc[reset[reset].index[-1]+1:].reset_index(drop=True)
+    return df
+
 ## Don't touch yet
 def parseStations(inFile):
     df = pullIn(inFile)
     df.dropna(thresh=4,inplace=True) # cut rows with less than 2 values
     df.dropna(thresh=4,axis=1,inplace=True) # drop most note cols
-    df.columns = df.iloc[0] # Fix header
-    df = df[1:] # Drop inline header
+    if df.attrs.get('profile') != 'Stations':
+        df.columns = df.iloc[0] # Fix header
+        df = df[1:] # Drop inline header
     try:
         df['StationID'] = df['Line']+df['Letter']+'-'+df['Number'].astype(str)
     except:
@@ -88,6 +259,9 @@ def parsePP(inFile):
 
 def parsePCN(inFile):
     df = pullIn(inFile)
+    if df.attrs.get('profile') == 'PCN': # header already stacked on read
+        df['Raw File'] = inFile
+        return df
     for index, row in df.iterrows():
         temp = row.astype(str).str.isnumeric()
         if any(temp):
@@ -105,11 +279,6 @@ def parsePCN(inFile):
 def parseNUT(inFile):
     dropCols = ['NeedleNumber','ResultID','Position','SampleType','SampleIdentity']
     df = pullIn(inFile)
-    # Match what columns to keep
-    realCols = df.columns
-    analCols = ['NO3 NO2','PO4','NO2','NH4','D Si']
-    realAnal = [val for val in realCols if any(anal in analCols for anal in analCols)]
-    df.columns = realAnal
     # Drop empty cols and rename to Sample Id
     df.dropna(axis=1,how='all',inplace=True)
     sidCol = df.columns.get_loc('NeedleNumber')-1
@@ -128,14 +297,18 @@ def parseNUT(inFile):
 
 def parseDICTNDOC(inFile):
     cleanDFs,drift = {},{}
+    profile        = PROFILES['TOC-L']
+    standards      = profile['standards']
     keepCols       = ['Sample Name','Conc.']
     originalCols   = ['Type','Anal.','Sample Name','Sample ID','Origin',
                       'Cal. Curve','Manual Dilution','Notes','Date / Time',
                       'Spl. No.','Inj. No.','Analysis(Inj.)','Area','Conc.',
                       'Result','Excluded','Inj. Vol.']
-    checkNames     = ['QC','Q','L','H'] # Possible check 'Sample Names'
-    checkIDsHigh   = ['Spike','H']      # Possible high check 'Sample IDs'
+    checkNames     = list(standards['checkNames'])   # Possible check 'Sample Names'
+    checkIDsHigh   = list(standards['checkIDsHigh']) # Possible high check 'Sample IDs'
+    emptyVial      = standards['emptyVial']
     df = pullIn(inFile)
+    df = cleanRuns(df) # before exclusions, same as the MATLAB script
     # Handle column names
     # neededfill = len(df.columns)-len(originalCols) # get num of columns
     # if neededfill > 0: #fill to the left if not enough column names
@@ -192,17 +365,14 @@ def parseDICTNDOC(inFile):
             try:
                 drift = dfs[i][(dfs[i]['Sample ID'].isin(checkIDsHigh)) | 
                                (dfs[i]['Sample Name'].isin(checkIDsHigh))]
-                drift = drift[drift['Conc.'] > 1.5] # Scrub empty vials
+                drift = drift[drift['Conc.'] > emptyVial] # Scrub empty vials
                 absDiff = (highStd - drift['Conc.']).abs().max()
                 cleanDFs[i]['Max % Abs. Diff of High Check'] = absDiff/highStd*100
             except:
                 print("Could not generate QC figures, check naming convention.")
             # Linear regression for low drift
             try:
-                try:
-                    xtimes = pd.to_datetime(drift['Date / Time'],format="%m/%d/%Y %I:%M:%S %p")
-                except:
-                    xtimes = pd.to_datetime(drift['Date / Time'],format="%Y/%m/%d %H:%M:%S")
+                xtimes = parseTimes(drift[profile['timeCol']],profile['timeFormats'])
                 xt = xtimes[0:]-xtimes.iat[0]
                 xt = xt.dt.total_seconds()/(60*60)
                 x1 = xt.values